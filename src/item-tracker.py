@@ -3,11 +3,18 @@ from asyncio import (
     get_event_loop,
     sleep
 )
+from enum import (
+    Enum
+)
+from functools import (
+    partial
+)
 from itertools import (
     count
 )
 from json import (
-    load
+    load,
+    loads
 )
 from os import (
     environ,
@@ -19,6 +26,11 @@ from re import (
 from smtplib import (
     SMTP
 )
+from urllib.parse import (
+    parse_qs,
+    urlsplit,
+    urlunsplit
+)
 from uuid import (
     uuid4
 )
@@ -26,6 +38,9 @@ from uuid import (
 from fastcore.utils import (
     store_attr
 )
+from requests import (
+    get
+)
 from selenium.webdriver import (
     Firefox
 )
@@ -264,10 +279,209 @@ class ScraperFactory():
 
         return scrapers
 
+def _get_variant(url):
+    """Get the Shopify variant id of a url.
+
+    Args:
+        url (str): product url
+    Returns:
+        (str): variant id, or None if not specified
+    """
+
+    if not isinstance(url, str):
+        return None
+
+    return parse_qs(urlsplit(url).query).get("variant", [None])[0]
+
+class Availability(Enum):
+    IN_STOCK = "IN STOCK"
+    OUT_OF_STOCK = "OUT OF STOCK"
+    PREORDER = "PREORDER"
+
+    @classmethod
+    def from_schema(cls, value):
+        """Normalize a schema.org availability value.
+
+        Args:
+            value (str): schema.org ItemAvailability (e.g. "https://schema.org/InStock")
+        Returns:
+            (Availability): availability, or None if unrecognized
+        """
+
+        schema_availability = {
+            "INSTOCK": cls.IN_STOCK,
+            "INSTOREONLY": cls.IN_STOCK,
+            "ONLINEONLY": cls.IN_STOCK,
+            "LIMITEDAVAILABILITY": cls.IN_STOCK,
+            "OUTOFSTOCK": cls.OUT_OF_STOCK,
+            "SOLDOUT": cls.OUT_OF_STOCK,
+            "DISCONTINUED": cls.OUT_OF_STOCK,
+            "PREORDER": cls.PREORDER,
+            "PRESALE": cls.PREORDER,
+            "BACKORDER": cls.IN_STOCK
+        }
+
+        if not isinstance(value, str):
+            return None
+
+        return schema_availability.get(value.rstrip("/").split("/")[-1].upper())
+
+    @classmethod
+    def combine(cls, availabilities):
+        """Reduce several offer availabilities to one.
+
+        Args:
+            availabilities (list): offer availabilities
+        Returns:
+            (Availability): most available state, or None if empty
+        """
+
+        for i in [cls.IN_STOCK, cls.PREORDER, cls.OUT_OF_STOCK]:
+            if i in availabilities:
+                return i
+        else:
+            return None
+
+class JsonLdExtractor:
+    is_structured = True
+    uses_driver = True
+
+    async def extract(self, scraper, url):
+        """Extract availability from the JSON-LD product offers of the loaded page.
+
+        Args:
+            scraper (Scraper): scraper connected to the site
+            url (str): site url, optionally with a variant query
+        Returns:
+            (str): availability, or None if the page has no usable offers
+        """
+
+        try:
+            scripts = scraper.driver.find_elements(By.XPATH, "//script[@type='application/ld+json']")
+        except Exception as e:
+            logger.write(DEBUG, f"{self.__class__.__name__}.extract - {repr(e)}")
+            return None
+
+        documents = []
+        for i in scripts:
+            try:
+                documents.append(loads(i.get_attribute("textContent")))
+            except Exception as e:
+                logger.write(DEBUG, f"{self.__class__.__name__}.extract - {repr(e)}")
+
+        offers = self._find_offers(documents)
+        variant = _get_variant(url)
+        if variant is not None:
+            offers = [x for x in offers if _get_variant(x["url"]) == variant]
+        availability = Availability.combine([Availability.from_schema(x["availability"]) for x in offers])
+        if availability is None:
+            return None
+
+        scraper.driver.refresh()
+
+        return availability.value
+
+    def _find_offers(self, node, product_url=None, in_offers=False):
+        """Find offers of products in JSON-LD.
+
+        Args:
+            node (object): JSON-LD node
+            product_url (str): url of the product the node belongs to
+            in_offers (bool): node is nested under a product's offers
+        Returns:
+            (list): offers with "availability" and "url"
+        """
+
+        if isinstance(node, list):
+            return [y for x in node for y in self._find_offers(x, product_url, in_offers)]
+        if not isinstance(node, dict):
+            return []
+
+        node_type = node.get("@type", [])
+        node_types = node_type if isinstance(node_type, list) else [node_type]
+        node_url = node.get("url") if isinstance(node.get("url"), str) else product_url
+        offers = []
+        if (in_offers or "Offer" in node_types) and "availability" in node:
+            offers.append({"availability": node["availability"], "url": node_url})
+        if "Product" in node_types or "ProductGroup" in node_types or in_offers:
+            offers += self._find_offers(node.get("offers", []), node_url, True)
+        if "ProductGroup" in node_types:
+            offers += self._find_offers(node.get("hasVariant", []), node_url)
+        offers += self._find_offers(node.get("itemOffered", []), node_url)
+        offers += self._find_offers(node.get("mainEntity", []), product_url)
+        offers += self._find_offers(node.get("@graph", []), product_url, in_offers)
+
+        return offers
+
+class ShopifyProductExtractor:
+    is_structured = True
+    uses_driver = False
+
+    async def extract(self, scraper, url):
+        """Extract availability from the Shopify product JSON endpoint.
+
+        Args:
+            scraper (Scraper): scraper for the site
+            url (str): product url, optionally with a variant query
+        Returns:
+            (str): availability, or None if the endpoint is unusable
+        """
+
+        parts = urlsplit(url)
+        segments = parts.path.strip("/").split("/")
+        if "products" not in segments[:-1]:
+            return None
+        handle = segments[segments.index("products") + 1]
+        variant = _get_variant(url)
+
+        try:
+            response = await get_event_loop().run_in_executor(
+                None,
+                partial(
+                    get,
+                    urlunsplit((parts.scheme, parts.netloc, f"/products/{handle}.js", "", "")),
+                    timeout=scraper.max_wait_time
+                )
+            )
+            response.raise_for_status()
+            product = response.json()
+        except Exception as e:
+            logger.write(DEBUG, f"{self.__class__.__name__}.extract - {repr(e)}")
+            return None
+
+        if not isinstance(product, dict):
+            return None
+        if variant is not None:
+            variants = product.get("variants") if isinstance(product.get("variants"), list) else []
+            available = [x.get("available") for x in variants if isinstance(x, dict) and str(x.get("id")) == variant]
+        else:
+            available = [product.get("available")]
+        if len(available) == 0 or not isinstance(available[0], bool):
+            return None
+
+        return (Availability.IN_STOCK if available[0] else Availability.OUT_OF_STOCK).value
+
+class XpathExtractor:
+    is_structured = False
+    uses_driver = True
+
+    async def extract(self, scraper, url):
+        """Extract the visible text of the scraper's xpath target.
+
+        Args:
+            scraper (Scraper): scraper connected to the site
+            url (str): site url
+        Returns:
+            (str): text
+        """
+
+        return await scraper._get_target_text(scraper.e_property)
+
 class Scraper(ScrapeTiming):
     domain = ""
     xpath = ""
     e_property = None
+    extractors = [XpathExtractor()]
 
     def __init__(self, emailer, messenger, items, confirms=1):
         """Base class for scraping.
@@ -295,22 +509,29 @@ class Scraper(ScrapeTiming):
         self.stock_state = {
             x["name"]: {
                 "current_state": None,
+                "current_is_structured": None,
                 "pending_state": [None for _ in range(self.confirms)],
+                "pending_is_structured": None,
                 "excluded": x["exclude"]
             }
             for x in self.items
         }
 
-    def _add_state(self, item, state):
+    def _add_state(self, item, state, is_structured=False):
         """Add a state to an item.
 
         Args:
             item (str): item name
             state (str): availability
+            is_structured (bool): state is an Availability value rather than site text
         Returns:
             (bool): if state is confirmed
         """
 
+        # only confirm states read by the same kind of extractor
+        if self.stock_state[item]["pending_is_structured"] != is_structured:
+            self.stock_state[item]["pending_state"] = [None for _ in range(self.confirms)]
+            self.stock_state[item]["pending_is_structured"] = is_structured
         self.stock_state[item]["pending_state"] = self.stock_state[item]["pending_state"][1:] + [state]
         if (
             all([x == self.stock_state[item]["pending_state"][0] for x in self.stock_state[item]["pending_state"]]) and
@@ -318,6 +539,7 @@ class Scraper(ScrapeTiming):
         ):
             previous_state = self.stock_state[item]["current_state"]
             self.stock_state[item]["current_state"] = state
+            self.stock_state[item]["current_is_structured"] = is_structured
 
             return True if previous_state is not None else False
         else:
@@ -353,6 +575,23 @@ class Scraper(ScrapeTiming):
         self.driver.get(url)
         self.waiter.until(lambda x: x.execute_script("return document.readyState") == "complete")
 
+    def _disconnect(self):
+        """Close the site connection, if any.
+
+        Args:
+            N/A
+        Returns:
+            (None)
+        """
+
+        try:
+            self.driver.quit()
+        except Exception as e:
+            pass
+
+        self.driver = None
+        self.waiter = None
+
     def _send_communications(self, subject, message, email=None, phone=None):
         """Send all communications available.
 
@@ -388,7 +627,6 @@ class Scraper(ScrapeTiming):
             (str): text
         """
 
-        await sleep(self.site_load_time)
         elements = self.waiter.until(
             visibility_of_all_elements_located((By.XPATH, self.xpath))
         )
@@ -406,6 +644,29 @@ class Scraper(ScrapeTiming):
 
         return availability
 
+    async def _get_availability(self, url):
+        """Get availability from the first extractor that finds it.
+
+        Args:
+            url (str): site url
+        Returns:
+            (tuple): availability and the extractor that found it
+        """
+
+        await sleep(self.site_load_time)
+        for i in self.extractors:
+            # only start the browser once an extractor needs it
+            if i.uses_driver and self.driver is None:
+                self._reconnect(url)
+                await sleep(self.site_load_time)
+            availability = await i.extract(scraper=self, url=url)
+            if availability is not None:
+                if not i.uses_driver:
+                    self._disconnect()
+                return availability, i
+        else:
+            raise Exception("Availability not found")
+
     async def _scrape_item(self, item, initial=True):   
         """Scrape the site and send an alert when the state changes.
 
@@ -428,35 +689,38 @@ class Scraper(ScrapeTiming):
                 email_subscriptions = [y for x in item_db_entry["subscribers"] for y in x["email"]]
                 phone_subscriptions = [y for x in item_db_entry["subscribers"] for y in x["sms"]]
 
-                self._reconnect(url)
-
                 break
             except Exception as e:
                 logger.write(ERROR, f"{run_id} - {self.__class__.__name__}.scrape_item - {repr(e)}")
-                self._reconnect(url)
             finally:
                 await sleep(self.poll_time)
 
+        driver_runs = count(1)
         for i in count():
             try:
-                availability = await self._get_target_text(self.e_property)
-                is_state_changed = self._add_state(item=item, state=availability)
+                availability, extractor = await self._get_availability(url)
+                previous_is_structured = self.stock_state[item]["current_is_structured"]
+                is_state_changed = self._add_state(item=item, state=availability, is_structured=extractor.is_structured)
                 # record scrape attempt after no scrape-related failures
-                logger.write(INFO, f"{run_id} - {self.__class__.__name__}.scrape_item run {i}: {availability}")
+                logger.write(INFO, f"{run_id} - {self.__class__.__name__}.scrape_item run {i} ({extractor.__class__.__name__}): {availability}")
                 # when to send out an alert
                 if i == 0 and initial:
                     subject, message = f"Scraper ({item}) first run: {availability}", url
                     self._send_communications(subject=subject, message=message, email=email_subscriptions, phone=phone_subscriptions)
+                elif is_state_changed and previous_is_structured != extractor.is_structured:
+                    subject, message = f"Scraper ({item}) source changed: {availability}", url
+                    self._send_communications(subject=subject, message=message, email=email_subscriptions, phone=phone_subscriptions)
                 elif is_state_changed:
                     subject, message = f"Scraper ({item}) change detected: {availability}", url
                     self._send_communications(subject=subject, message=message, email=email_subscriptions, phone=phone_subscriptions)
 
-                if i % self.max_refreshes == 0:
+                if extractor.uses_driver and next(driver_runs) % self.max_refreshes == 0:
                     self._reconnect(url)
 
             except Exception as e:
                 logger.write(ERROR, f"{run_id} - {self.__class__.__name__}.scrape_item - {repr(e)}")
-                self._reconnect(url)
+                if self.driver is not None:
+                    self._reconnect(url)
             finally:
                 await sleep(self.poll_time)
 
@@ -474,10 +738,12 @@ class Scraper(ScrapeTiming):
 class AmazonJpScraper(Scraper):
     domain = "https://www.amazon.co.jp"
     xpath = "//*[@id='availability']/child::span[1]"
+    extractors = [JsonLdExtractor(), XpathExtractor()]
 
 class AmazonScraper(Scraper):
     domain = "https://www.amazon.com"
     xpath = "//*[@id='availability']/child::span[1]"
+    extractors = [JsonLdExtractor(), XpathExtractor()]
 
 class ClairesScraper(Scraper):
     domain = "https://www.claires.com"
@@ -494,6 +760,7 @@ class BathBodyWorksScraper(Scraper):
 class BestBuyScraper(Scraper):
     domain = "https://www.bestbuy.com"
     xpath = "(//div[@class='fulfillment-add-to-cart-button'])[1]"
+    extractors = [JsonLdExtractor(), XpathExtractor()]
 
 class FiveBelowScraper(Scraper):
     domain = "https://www.fivebelow.com"
@@ -519,6 +786,7 @@ class SmythsScraper(Scraper):
 class WalmartScraper(Scraper):
     domain = "https://www.walmart.com"
     xpath = "(//div[@class='flex flex-column']//text())[last()]"
+    extractors = [JsonLdExtractor(), XpathExtractor()]
 
 class BAMScraper(Scraper):
     domain = "https://www.booksamillion.com"
@@ -531,10 +799,12 @@ class BAMSearchScraper(Scraper):
 class OwlGooseGiftScraper(Scraper):
     domain = "https://owlandgoosegifts.com"
     xpath = "//span[@data-add-to-cart-text='']"
+    extractors = [ShopifyProductExtractor(), JsonLdExtractor(), XpathExtractor()]
 
 class QueeniesCardsScraper(Scraper):
     domain = "https://queeniescards.com"
     xpath = "//button[@id='AddToCart']"
+    extractors = [ShopifyProductExtractor(), JsonLdExtractor(), XpathExtractor()]
 
 class QueeniesCardsSortedScraper(Scraper):
     domain = "https://queeniescards.com/collections"
@@ -563,6 +833,7 @@ class ShopCowsScraper(Scraper):
 class TargetScraper(Scraper):
     domain = "https://www.target.com"
     xpath = "(//div[@data-test='flexible-fulfillment']//button)[last()]"
+    extractors = [JsonLdExtractor(), XpathExtractor()]
 
 class KidstuffScraper(Scraper):
     domain = "https://www.kidstuff.com.au"